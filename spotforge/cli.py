@@ -1,6 +1,7 @@
 # spotforge/cli.py
 
 import click
+import logging
 import sys
 import os
 from pathlib import Path
@@ -11,9 +12,10 @@ from spotforge.orchestrator import generate_storyboard, edit_panel, export_story
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 @click.group()
-def main():
+@click.option('--verbose', is_flag=True, help='Show debug logging, including tracebacks.')
+def main(verbose: bool):
     """SpotForge: Turn a single sentence into a polished, narrated, product-fused storyboard video."""
-    pass
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="[%(name)s] %(levelname)s: %(message)s")
 
 @main.command()
 @click.option('--brief', '-b', required=True, help='The one-sentence brief for the storyboard.')
@@ -55,11 +55,20 @@ PRESETS = {
     }
 }
 
+# Fields every preset must define; the prompter reads them directly.
+REQUIRED_PRESET_KEYS = ("description", "lighting", "background", "mood")
+
 def validate_config():
     """Checks if essential configuration is present."""
     errors = []
     if not OPENROUTER_API_KEY:
         errors.append("OPENROUTER_API_KEY not found in environment variables (.env file).")
+    if DEFAULT_STYLE not in PRESETS:
+        errors.append(f"DEFAULT_STYLE '{DEFAULT_STYLE}' is not one of the defined PRESETS.")
+    for name, preset in PRESETS.items():
+        missing = [key for key in REQUIRED_PRESET_KEYS if key not in preset]
+        if missing:
+            errors.append(f"Preset '{name}' is missing: {', '.join(missing)}.")
     return errors
 
 config_errors = validate_config()
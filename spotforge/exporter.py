@@ -1,199 +1,293 @@
 # spotforge/exporter.py
 
-from moviepy.editor import ImageClip, CompositeVideoClip, concatenate_videoclips # Import CompositeVideoClip for transitions
+from functools import lru_cache
 from pathlib import Path
-import json
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
 from spotforge import config
+from spotforge.utils import json_loads, apply_panel_updates, upgrade_plan_layout
+
+logger = logging.getLogger(__name__)
+
+VIDEO_FPS = 24
+PANEL_DURATION = 6 # Seconds each panel is held on screen
+TRANSITION_DURATION = 1.0 # Duration of the crossfade transition in seconds
+
+_FFMPEG_BIN = shutil.which("ffmpeg")
+SEGMENTS_DIR = config.CACHE_DIR / "segments" # Per-panel still segments, keyed by panel contents
+
+# Hardware H.264 encoders in order of preference; libx264 is the software fallback.
+_HARDWARE_ENCODERS = ("h264_videotoolbox", "h264_nvenc", "h264_qsv")
+_ENCODER_PARAMS = {
+    "h264_videotoolbox": ["-b:v", "8M"],
+    "h264_nvenc": ["-preset", "p4", "-tune", "hq"],
+    "h264_qsv": ["-preset", "veryfast"],
+    "libx264": ["-preset", "veryfast", "-tune", "stillimage", "-threads", str(os.cpu_count() or 0)],
+}
 
 def _load_shot_plan(filepath: Path) -> dict:
-    """Loads the shot plan from a JSON file."""
+    """Loads the shot plan from a JSON file, replaying any panel updates logged since it was written."""
     try:
-        with open(filepath, 'r') as f:
-            return json.load(f)
+        return apply_panel_updates(upgrade_plan_layout(json_loads(filepath.read_bytes())), filepath)
     except FileNotFoundError:
-        print(f"[Exporter] Error: Shot plan file not found: {filepath}")
+        logger.error("Shot plan file not found: %s", filepath)
         return None
     except Exception as e:
-        print(f"[Exporter] Error loading shot plan: {e}")
+        logger.error("Error loading shot plan: %s", e)
         return None
 
+def _encode_panel_segment(img_path: Path, duration: float) -> Path:
+    """Encodes one still panel as a short H.264 segment, reusing the cached segment if the panel is unchanged."""
+    stat = img_path.stat()
+    fingerprint = f"{img_path.resolve()}|{stat.st_mtime_ns}|{stat.st_size}|{duration}|{config.RESOLUTION}|{VIDEO_FPS}"
+    key = hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+    segment_path = SEGMENTS_DIR / f"{img_path.stem}_{key}.mp4"
+    if segment_path.exists():
+        logger.info("Reusing cached segment for %s", img_path.name)
+        return segment_path
+
+    SEGMENTS_DIR.mkdir(parents=True, exist_ok=True)
+    width, height = config.RESOLUTION
+    tmp_path = segment_path.with_name(segment_path.stem + ".tmp.mp4")
+    command = [
+        _FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error",
+        "-loop", "1", "-framerate", str(VIDEO_FPS), "-t", str(duration), "-i", str(img_path),
+        "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+               f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,format=yuv420p",
+        # Lossless intermediate: repeated frames cost next to nothing and the
+        # final encode does not stack a second round of compression artifacts.
+        "-c:v", "libx264", "-preset", "veryfast", "-tune", "stillimage", "-qp", "0",
+        str(tmp_path),
+    ]
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        logger.error("Failed to encode segment for %s: %s", img_path.name, e.stderr.strip()[-1000:])
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, segment_path)
+
+    # Drop segments left over from earlier versions of this panel.
+    for stale in SEGMENTS_DIR.glob(f"{img_path.stem}_*.mp4"):
+        if stale != segment_path:
+            stale.unlink(missing_ok=True)
+    return segment_path
+
+def prepare_panel_segment(image_path: Path):
+    """Pre-encodes a freshly generated panel so a later export only has to join segments.
+
+    Failures are reported but not raised; the export encodes any missing segment itself.
+    """
+    if not _FFMPEG_BIN:
+        return
+    try:
+        _encode_panel_segment(Path(image_path), PANEL_DURATION)
+    except Exception as e:
+        logger.warning("Could not pre-encode segment for %s: %s", image_path, e)
+
+def _build_xfade_filter(durations: list, transition_duration: float) -> str:
+    """Builds an ffmpeg filtergraph that chains xfade between consecutive inputs."""
+    # Each crossfade starts transition_duration before the end of the video built so far.
+    filters = []
+    previous_label = "0:v"
+    elapsed = durations[0]
+    for i in range(1, len(durations)):
+        offset = elapsed - transition_duration
+        label = f"x{i}"
+        filters.append(
+            f"[{previous_label}][{i}:v]xfade=transition=fade:duration={transition_duration}:offset={offset}[{label}]"
+        )
+        previous_label = label
+        elapsed = offset + durations[i]
+
+    filters.append(f"[{previous_label}]null[vout]")
+    return ";".join(filters)
+
 def _create_video_from_panels(image_paths: list, durations: list, output_path: Path):
     """Creates an MP4 slideshow from a list of image paths with crossfade transitions."""
+    if not image_paths:
+        logger.info("No panels to render.")
+        return
+
+    if not _FFMPEG_BIN:
+        logger.info("ffmpeg not found on PATH, falling back to moviepy.")
+        _create_video_with_moviepy(image_paths, durations, output_path)
+        return
+
+    logger.info("Creating video from %s panels with transitions...", len(image_paths))
+    inputs = []
+    for img_path, duration in zip(image_paths, durations):
+        inputs += ["-i", str(_encode_panel_segment(Path(img_path), duration))]
+    filter_graph = _build_xfade_filter(durations, TRANSITION_DURATION)
+
+    encoder = _select_video_encoder()
+    try:
+        _run_ffmpeg_encode(inputs, filter_graph, encoder, output_path)
+    except subprocess.CalledProcessError as e:
+        if encoder == "libx264":
+            raise
+        # Encoders can be compiled in without the matching hardware present.
+        logger.warning("Encoder %s failed (%s), retrying with libx264.", encoder, e.stderr.strip()[-300:])
+        _run_ffmpeg_encode(inputs, filter_graph, "libx264", output_path)
+
+@lru_cache(maxsize=None)
+def _select_video_encoder() -> str:
+    """Returns the preferred H.264 encoder available in the local ffmpeg build."""
+    try:
+        result = subprocess.run([_FFMPEG_BIN, "-hide_banner", "-encoders"], check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Could not list ffmpeg encoders: %s", e)
+        return "libx264"
+
+    available = {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+    for encoder in _HARDWARE_ENCODERS:
+        if encoder in available:
+            return encoder
+    return "libx264"
+
+def _run_ffmpeg_encode(inputs: list, filter_graph: str, encoder: str, output_path: Path):
+    """Runs ffmpeg over the prepared inputs and filtergraph with the given encoder."""
+    command = [
+        _FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error",
+        *inputs,
+        "-filter_complex", filter_graph,
+        "-map", "[vout]",
+        "-r", str(VIDEO_FPS),
+        "-c:v", encoder, *_ENCODER_PARAMS[encoder],
+        # Stills and fades gain nothing from B-frame decisions.
+        "-bf", "0",
+        "-pix_fmt", "yuv420p",
+        str(output_path),
+    ]
+    logger.info("Encoding with %s...", encoder)
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+        logger.info("Video saved to %s", output_path)
+    except subprocess.CalledProcessError as e:
+        logger.error("ffmpeg failed with exit code %s: %s", e.returncode, e.stderr.strip()[-1000:])
+        raise
+
+def _load_frame_at_resolution(img_path):
+    """Loads a panel as an RGB frame of exactly config.RESOLUTION.
+
+    The generator does not enforce the resolution, so panels of another size
+    are fitted and letterboxed in black, like the ffmpeg path's scale+pad.
+    """
+    import numpy
+    from PIL import Image, ImageOps
+    with Image.open(img_path) as img:
+        img = img.convert("RGB")
+        if img.size != tuple(config.RESOLUTION):
+            img = ImageOps.pad(img, tuple(config.RESOLUTION), color=(0, 0, 0))
+        return numpy.asarray(img)
+
+def _create_video_with_moviepy(image_paths: list, durations: list, output_path: Path):
+    """Creates the slideshow with moviepy; used when no ffmpeg binary is on the PATH."""
+    # Imported here: moviepy drags in numpy/imageio and is only needed for this fallback.
+    from moviepy.editor import ImageClip, concatenate_videoclips
     try:
-        print(f"[Exporter] Creating video from {len(image_paths)} panels with transitions...")
+        logger.info("Creating video from %s panels with moviepy...", len(image_paths))
         clips = []
-        transition_duration = 1.0 # Duration of the crossfade transition in seconds
+        transition_duration = TRANSITION_DURATION
 
         for i, (img_path, duration) in enumerate(zip(image_paths, durations)):
             # Create a clip for each image with the specified duration
-            clip = ImageClip(str(img_path)).set_duration(duration)
+            clip = ImageClip(_load_frame_at_resolution(img_path)).set_duration(duration)
             clips.append(clip)
 
-        # --- Corrected Transition Logic for moviepy 1.0.3 ---
-        # To add a crossfade, we need to manually apply the effect between clips.
-        # We'll create a new list of clips where transitions are embedded.
-
         if not clips:
-            print("[Exporter] No clips to concatenate.")
+            logger.info("No clips to concatenate.")
             return
 
-        # Start with the first clip
-        final_clip = clips[0]
-
-        # Iterate through the remaining clips and add them with a transition
-        for i in range(1, len(clips)):
-            next_clip = clips[i]
-
-            # Apply crossfadein to the *next* clip starting from its beginning
-            # This creates the fade-in effect for the next clip, overlapping with the fade-out of the current one.
-            next_clip_with_fade = next_clip.crossfadein(transition_duration)
-
-            # Concatenate the current final clip with the next clip that has the fade-in
-            # We need to use CompositeVideoClip or a similar approach for overlapping.
-            # The simplest way is often to use a function that handles the transition explicitly.
-            # moviepy doesn't have a built-in concat with *only* crossfade as an argument for the function itself.
-            # We build it step by step.
-
-            # The 'method="compose"' argument in concatenate_videoclips might be related to handling
-            # alpha channels or compositing layers correctly during the transition, which is important for fades.
-            # Since 'cross' is invalid, we rely on applying crossfadein/crossfadeout manually and concatenating.
-
-            # Ensure the previous clip fades out correctly if needed, though crossfadein on the next clip
-            # often handles the visual overlap.
-            # Let's try concatenating the current final with the *next* clip that has crossfadein applied.
-            # This might require a more complex loop or using CompositeVideoClip for each pair,
-            # which concatenate_videoclips might handle internally *if* the 'cross' arg worked.
-
-            # The safest way with the basic API is to apply fades and use the standard concatenate.
-            # For a true crossfade, apply fadeout to the current clip and fadein to the next,
-            # then concatenate. moviepy's concatenate_videoclips *should* handle the overlap if fades are present,
-            # but the original function call suggested it might need a specific method.
-
-            # Let's try applying fadeout to the *previous* clip in the pair being concatenated.
-            # This is the standard way for a crossfade between two specific clips.
-            current_clip_for_transition = final_clip
-            next_clip_for_transition = next_clip_with_fade
-
-            # Apply fade-out to the current final clip
-            current_clip_for_transition = current_clip_for_transition.crossfadeout(transition_duration)
-
-            # Now concatenate these two specific clips (with their fades) into a temporary sequence
-            # We need to concatenate just these two, respecting the fade durations.
-            # The standard concatenate_videoclips might handle the overlap correctly if fades are present.
-            temp_sequence = [current_clip_for_transition, next_clip_for_transition]
-            # Concatenate only these two, with method="compose" to ensure layers are handled correctly for fades.
-            # This is the key: apply fades to adjacent clips and concatenate them *as a pair* if needed,
-            # or rely on the global concatenate to handle overlaps correctly when fades are present.
-
-            # The *global* concatenate_videoclips should take a list where adjacent clips have fade-in/fade-out
-            # applied. It should automatically handle the overlapping duration specified by the fades.
-            # Let's rebuild the 'clips' list with the fades already applied.
-
-            # This approach modifies the original clips list by applying fades strategically.
-            # We'll iterate through the original list again, but this time apply fadeouts and fadeins
-            # to the original clips before the final global concatenate.
-
-            # Re-initialize the clips list with fades applied correctly
-            clips_with_fades = []
-            for i in range(len(clips)):
-                clip = clips[i]
-                if i > 0: # Apply fade-in to all clips except the first
-                    clip = clip.crossfadein(transition_duration)
-                if i < len(clips) - 1: # Apply fade-out to all clips except the last
-                    clip = clip.crossfadeout(transition_duration)
-                clips_with_fades.append(clip)
-
-            # Now, concatenate the list where adjacent clips have appropriate fades
-            # The 'method="compose"' might be needed here if fades involve alpha channels.
-            final_clip = CompositeVideoClip(clips_with_fades, size=clips_with_fades[0].size) # This might not be the right way for a linear sequence.
-            # CompositeVideoClip is for layering, not sequential concatenation.
-
-            # The correct way is back to concatenate_videoclips, but with fades already applied to individual clips.
-            # The 'method' argument might be relevant, let's try without 'cross' but with 'method'.
-            # The original error was specifically about 'cross'. Let's remove it and ensure fades are on the clips.
-            final_clip = clips_with_fades[0]
-            for next_clip_faded in clips_with_fades[1:]:
-                 final_clip = CompositeVideoClip([final_clip, next_clip_faded.set_start(final_clip.duration - transition_duration)], size=final_clip.size)
-                 # This CompositeVideoClip approach overlays them. We need to cut the *previous* clip short.
-                 # Let's go back to building a sequence correctly with concatenate_videoclips *after* applying fades.
-
-            # The standard approach *should* be:
-            # 1. Apply crossfadein to clip[1..N]
-            # 2. Apply crossfadeout to clip[0..N-1]
-            # 3. Pass the resulting list to concatenate_videoclips.
-            # Let's try this final structure:
-            clips_for_concat = []
-            for i in range(len(clips)):
-                clip = clips[i]
-                # Apply fade-in if not the first clip
-                if i > 0:
-                    clip = clip.crossfadein(transition_duration)
-                # Apply fade-out if not the last clip
-                if i < len(clips) - 1:
-                    clip = clip.crossfadeout(transition_duration)
-                clips_for_concat.append(clip)
-
-            # Now concatenate the list of pre-faded clips
-            # The 'method' argument might help with compositing the fades correctly.
-            # The 'cross' argument was likely a shortcut that doesn't exist in this version.
-            final_clip = concatenate_videoclips(clips_for_concat, method="compose") # Remove 'cross', keep 'method' if helpful for alpha.
+        # Every clip was brought to config.RESOLUTION above, so the clips can be
+        # chained directly instead of composited frame by frame. The fades are baked
+        # into the frames (to/from black), which is what the masked
+        # crossfades looked like once composited over the black background.
+        clips_for_concat = []
+        for i, clip in enumerate(clips):
+            if i > 0: # Fade in all clips except the first
+                clip = clip.fadein(transition_duration)
+            if i < len(clips) - 1: # Fade out all clips except the last
+                clip = clip.fadeout(transition_duration)
+            clips_for_concat.append(clip)
+
+        final_clip = concatenate_videoclips(clips_for_concat, method="chain")
 
         # Write the video file
-        final_clip.write_videofile(str(output_path), fps=24, codec='libx264', audio=False)
-        print(f"[Exporter] Video saved to {output_path}")
+        # Panels are static, so motion estimation, B-frames and trellis buy nothing.
+        final_clip.write_videofile(
+            str(output_path),
+            fps=VIDEO_FPS,
+            codec='libx264',
+            audio=False,
+            preset='ultrafast',
+            threads=os.cpu_count(),
+            ffmpeg_params=[
+                "-tune", "stillimage",
+                "-x264-params", "ref=1:bframes=0:me=dia:subme=1:trellis=0:rc-lookahead=0",
+                "-g", str(VIDEO_FPS),
+            ],
+        )
+        logger.info("Video saved to %s", output_path)
     except Exception as e:
-        print(f"[Exporter] Error creating video: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error("Error creating video: %s", e)
+        logger.debug("Video creation traceback:", exc_info=True)
         raise
 
 def _create_shot_list_text(shot_plan: dict, output_path: Path):
     """Creates a text file listing the shot descriptions."""
     try:
-        print(f"[Exporter] Creating shot list text file...")
-        with open(output_path, 'w') as f:
-            f.write("--- SpotForge Storyboard Shot List ---\n\n")
-            panel_ids = sorted(shot_plan.get("panels", {}).keys(), key=int)
-            for panel_id_str in panel_ids:
-                panel_data = shot_plan["panels"][panel_id_str]
-                f.write(f"--- Panel {panel_data['id']} ---\n")
-                f.write(f"Goal: {panel_data.get('goal', 'N/A')}\n")
-                f.write(f"Scene: {panel_data.get('scene_description', 'N/A')}\n")
-                f.write("\n")
-        print(f"[Exporter] Shot list saved to {output_path}")
+        logger.info("Creating shot list text file...")
+        body = "--- SpotForge Storyboard Shot List ---\n\n" + "".join(
+            f"--- Panel {panel_data['id']} ---\n"
+            f"Goal: {panel_data.get('goal', 'N/A')}\n"
+            f"Scene: {panel_data.get('scene_description', 'N/A')}\n"
+            "\n"
+            for panel_data in shot_plan.get("panels", [])
+        )
+        Path(output_path).write_text(body)
+        logger.info("Shot list saved to %s", output_path)
     except Exception as e:
-        print(f"[Exporter] Error creating shot list: {e}")
+        logger.error("Error creating shot list: %s", e)
         raise
 
 def export_final_storyboard(include_narration: bool = False, voice_id: str = 'default') -> bool:
     """Exports the final storyboard as MP4 and shot list text file."""
-    print("[Exporter] Starting export process...")
+    logger.info("Starting export process...")
     
     try:
         plan_file_path = config.PROJECT_ROOT / "shot_plan.json"
         shot_plan = _load_shot_plan(plan_file_path)
         
         if not shot_plan:
-            print("[Exporter] Cannot export: Shot plan not found or invalid.")
+            logger.error("Cannot export: Shot plan not found or invalid.")
             return False
 
-        panel_ids = sorted(shot_plan.get("panels", {}).keys(), key=int)
+        # Panels are always written to PANELS_DIR, so one directory listing
+        # replaces a stat call per panel.
+        existing_panels = {entry.name for entry in os.scandir(config.PANELS_DIR)}
         image_paths = []
-        durations = []
-        for panel_id_str in panel_ids:
-            panel_data = shot_plan["panels"][panel_id_str]
+        missing_panels = []
+        for panel_data in shot_plan.get("panels", []):
             img_path_str = panel_data.get("generated_image_path")
-            if img_path_str:
+            if img_path_str and Path(img_path_str).name in existing_panels:
                 image_paths.append(Path(img_path_str))
-                durations.append(6) # 6 seconds per panel
             else:
-                print(f"[Exporter] Warning: No image path found for Panel {panel_id_str}. Skipping.")
-                return False 
+                missing_panels.append(str(panel_data["id"]))
+
+        if missing_panels:
+            logger.error("No image found for panel(s) %s. Generate them before exporting.", ', '.join(missing_panels))
+            return False
 
         if not image_paths:
-            print("[Exporter] Error: No valid image paths found in shot plan.")
+            logger.error("No valid image paths found in shot plan.")
             return False
 
+        durations = [PANEL_DURATION] * len(image_paths)
+
         video_output_path = config.EXPORTS_DIR / "storyboard.mp4"
         text_output_path = config.EXPORTS_DIR / "shot_list.txt"
 
@@ -202,16 +296,16 @@ def export_final_storyboard(include_narration: bool = False, voice_id: str = 'de
 
         _create_shot_list_text(shot_plan, text_output_path)
 
-        print("[Exporter] Export process completed successfully!")
+        logger.info("Export process completed successfully!")
         return True
 
     except Exception as e:
-        print(f"[Exporter] Export process failed: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error("Export process failed: %s", e)
+        logger.debug("Export traceback:", exc_info=True)
         return False
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="[%(name)s] %(levelname)s: %(message)s")
     success = export_final_storyboard()
     if success:
         print("Direct export test successful!")
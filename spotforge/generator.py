@@ -1,14 +1,38 @@
 # spotforge/generator.py
 
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import binascii
+import hashlib
 import io
+import logging
+import os
 import re
+import shutil
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
-from PIL import Image
+from typing import Callable
 from spotforge import config
+from spotforge.utils import json_dumps
 import time
 
+logger = logging.getLogger(__name__)
+
+# Shared HTTP session so keep-alive connections (and their TLS sessions) are
+# reused across panel requests instead of re-handshaking on every call. The
+# pool is sized so every concurrent panel worker can hold its own connection.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=max(16, config.MAX_PANELS)))
+
+_BASE64_RE = re.compile(r'data:image/\w+;base64,([A-Za-z0-9+/=]+)')
+_RAW_BASE64_PREFIX_RE = re.compile(r'[A-Za-z0-9+/]{64}')
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_PNG_IEND_CHUNK = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
 def _construct_prompt(panel_data: dict) -> str:
     """Constructs the final prompt string for the API call from panel data."""
     scene_desc = panel_data.get("scene_description", "")
@@ -28,15 +52,20 @@ def _construct_prompt(panel_data: dict) -> str:
     )
     return final_prompt
 
+@lru_cache(maxsize=4)
+def _encode_image_file(image_path: str, mtime_ns: int, size: int) -> str:
+    """Reads and base64-encodes an image file. mtime_ns and size only key the cache."""
+    with open(image_path, "rb") as img_file:
+        image_bytes = img_file.read()
+    return base64.b64encode(image_bytes).decode('utf-8')
+
 def _encode_image_to_base64(image_path: str) -> str:
-    """Encodes an image file to a base64 string."""
+    """Encodes an image file to a base64 string, reusing the result while the file is unchanged."""
     try:
-        with open(image_path, "rb") as img_file:
-            image_bytes = img_file.read()
-        encoded_image = base64.b64encode(image_bytes).decode('utf-8')
-        return encoded_image
+        stat = os.stat(image_path)
+        return _encode_image_file(str(image_path), stat.st_mtime_ns, stat.st_size)
     except Exception as e:
-        print(f"[Generator] Error encoding image {image_path}: {e}")
+        logger.error("Error encoding image %s: %s", image_path, e)
         raise
 
 def _extract_image_from_response(response_data: dict) -> bytes:
@@ -56,20 +85,20 @@ def _extract_image_from_response(response_data: dict) -> bytes:
                         return base64.b64decode(b64_data)
             
             # Method 2: Check for content that might contain base64 image
-            if 'message' in choice and 'content' in choice['message']:
-                content = choice['message']['content']
+            content = choice.get('message', {}).get('content')
+            if isinstance(content, str):
                 # Look for base64 image pattern in content
-                base64_pattern = r'data:image/\w+;base64,([A-Za-z0-9+/=]+)'
-                matches = re.findall(base64_pattern, content)
-                if matches:
-                    return base64.b64decode(matches[0])
+                match = _BASE64_RE.search(content)
+                if match:
+                    return base64.b64decode(match.group(1))
                 
-                # If content is directly base64 encoded image data
-                if len(content) > 1000:  # Heuristic: base64 images are large
+                # If content is directly base64 encoded image data. Only the
+                # prefix is checked, so plain-text replies are rejected without
+                # decoding the whole body.
+                if len(content) > 1000 and _RAW_BASE64_PREFIX_RE.match(content):  # Heuristic: base64 images are large
                     try:
-                        # Try to decode as base64 directly
                         return base64.b64decode(content)
-                    except:
+                    except binascii.Error:
                         pass
             
             # Method 3: Check for alternative response structure
@@ -80,13 +109,30 @@ def _extract_image_from_response(response_data: dict) -> bytes:
                     if image_data:
                         return base64.b64decode(image_data)
         
-        print(f"[Generator] Could not extract image from response structure: {response_data.keys()}")
+        logger.warning("Could not extract image from response structure: %s", response_data.keys())
         return None
         
     except Exception as e:
-        print(f"[Generator] Error extracting image from response: {e}")
+        logger.error("Error extracting image from response: %s", e)
         return None
 
+@lru_cache(maxsize=4)
+def _image_content_part(encoded_image: str) -> dict:
+    """Builds the image_url content part once per encoded image. The dict is shared, so don't mutate it."""
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/jpeg;base64,{encoded_image}"
+        }
+    }
+
+def _build_user_content(prompt: str, encoded_image: str = None) -> list:
+    """Builds the user message content: the panel's text prompt plus the shared product image part."""
+    content = [{"type": "text", "text": prompt}]
+    if encoded_image:
+        content.append(_image_content_part(encoded_image))
+    return content
+
 def _call_openrouter_api(prompt: str, product_image_path: str = None, retries: int = 3, delay: int = 5) -> bytes:
     """Calls the OpenRouter API to generate an image."""
     
@@ -107,6 +153,19 @@ def _call_openrouter_api(prompt: str, product_image_path: str = None, retries: i
         "Return ONLY the generated image as base64 data, no additional text."
     )
 
+    # Resolve the product image first so the payload is built in one go.
+    encoded_image = None
+    if product_image_path and Path(product_image_path).exists():
+        logger.info("Adding product image for fusion: %s", product_image_path)
+        try:
+            encoded_image = _encode_image_to_base64(product_image_path)
+            logger.debug("Product image data (base64) added to request.")
+        except Exception as img_err:
+            logger.warning("Failed to load/encode product image %s: %s. Proceeding without fusion for this call.", product_image_path, img_err)
+    else:
+        if product_image_path:
+            logger.warning("Product image path '%s' not found. Proceeding without fusion.", product_image_path)
+
     # Prepare the payload
     payload = {
         "model": config.OPENROUTER_MODEL,
@@ -117,112 +176,174 @@ def _call_openrouter_api(prompt: str, product_image_path: str = None, retries: i
             },
             {
                 "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
+                "content": _build_user_content(prompt, encoded_image)
             }
         ],
         "max_tokens": 1000,
         "temperature": 0.7,
     }
 
-    # Add the image to the payload if provided
-    if product_image_path and Path(product_image_path).exists():
-        print(f"[Generator] Adding product image for fusion: {product_image_path}")
-        try:
-            encoded_image = _encode_image_to_base64(product_image_path)
-            # Modify the user message content to include the image
-            payload["messages"][1]["content"].append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{encoded_image}"
-                }
-            })
-            print("[Generator] Product image data (base64) added to request.")
-        except Exception as img_err:
-            print(f"[Generator] Warning: Failed to load/encode product image {product_image_path}: {img_err}. Proceeding without fusion for this call.")
-    else:
-        if product_image_path:
-            print(f"[Generator] Warning: Product image path '{product_image_path}' not found. Proceeding without fusion.")
-
     for attempt in range(retries + 1):
         try:
-            print(f"[Generator] Calling OpenRouter API (Attempt {attempt + 1}/{retries + 1})...")
-            response = requests.post(config.OPENROUTER_BASE_URL, headers=headers, json=payload, timeout=120)
+            logger.info("Calling OpenRouter API (Attempt %s/%s)...", attempt + 1, retries + 1)
+            response = _session.post(config.OPENROUTER_BASE_URL, headers=headers, json=payload, timeout=120)
             
             if response.status_code == 200:
                 response_data = response.json()
-                print(f"[Generator] API call successful, extracting image data...")
+                logger.info("API call successful, extracting image data...")
                 
                 # Extract image from response
                 image_bytes = _extract_image_from_response(response_data)
                 
                 if image_bytes:
-                    print(f"[Generator] Successfully extracted image data ({len(image_bytes)} bytes)")
+                    logger.info("Successfully extracted image data (%s bytes)", len(image_bytes))
                     return image_bytes
                 else:
-                    print(f"[Generator] Could not extract image from response. Response structure: {list(response_data.keys())}")
+                    logger.warning("Could not extract image from response. Response structure: %s", list(response_data.keys()))
                     if 'choices' in response_data:
                         choice = response_data['choices'][0]
-                        print(f"[Generator] Choice keys: {choice.keys() if isinstance(choice, dict) else 'N/A'}")
+                        logger.debug("Choice keys: %s", choice.keys() if isinstance(choice, dict) else 'N/A')
                         if 'message' in choice:
-                            print(f"[Generator] Message keys: {choice['message'].keys()}")
+                            logger.debug("Message keys: %s", choice['message'].keys())
                     
                     # Save debug info
                     debug_file = config.CACHE_DIR / f"api_response_debug_{int(time.time())}.json"
-                    with open(debug_file, 'w') as f:
-                        import json
-                        # Remove large base64 data for readability
-                        debug_data = response_data.copy()
-                        if 'choices' in debug_data:
-                            for choice in debug_data['choices']:
-                                if 'message' in choice and 'content' in choice['message']:
-                                    content = choice['message']['content']
-                                    if len(content) > 500:
-                                        choice['message']['content'] = content[:500] + "...[truncated]"
-                        json.dump(debug_data, f, indent=2)
-                    print(f"[Generator] Saved debug response to: {debug_file}")
+                    # Remove large base64 data for readability
+                    debug_data = response_data.copy()
+                    if 'choices' in debug_data:
+                        for choice in debug_data['choices']:
+                            content = choice.get('message', {}).get('content')
+                            if isinstance(content, str) and len(content) > 500:
+                                choice['message']['content'] = content[:500] + "...[truncated]"
+                    debug_file.write_bytes(json_dumps(debug_data))
+                    logger.info("Saved debug response to: %s", debug_file)
                     
                     raise Exception("Could not extract image data from API response")
                     
             else:
-                print(f"[Generator] API call failed with status {response.status_code}: {response.text[:500]}")
+                logger.warning("API call failed with status %s: %s", response.status_code, response.text[:500])
                 raise Exception(f"API call failed with status {response.status_code}")
 
         except Exception as e:
-            print(f"[Generator] API call failed: {e}")
+            logger.warning("API call failed: %s", e)
             if attempt < retries:
-                print(f"[Generator] Retrying in {delay} seconds...")
+                logger.info("Retrying in %s seconds...", delay)
                 time.sleep(delay)
             else:
                 raise  # Re-raise the last exception if all retries failed
 
+def _response_cache_key(prompt: str, product_image_path: str = None) -> str:
+    """Builds a content hash of everything that determines the generated image."""
+    hasher = hashlib.sha256(prompt.encode('utf-8'))
+    if product_image_path and Path(product_image_path).exists():
+        try:
+            hasher.update(_encode_image_to_base64(product_image_path).encode('ascii'))
+        except Exception as e:
+            # The API call will warn and proceed without fusion, so key the
+            # request that is actually sent: the prompt alone.
+            logger.debug("Product image %s left out of the cache key: %s", product_image_path, e)
+    hasher.update(config.OPENROUTER_MODEL.encode('utf-8'))
+    return hasher.hexdigest()
+
 def _save_image(image_data: bytes, filepath: Path):
-    """Saves image bytes to a file."""
+    """Saves image bytes to a PNG file, converting only when the data isn't PNG already."""
     try:
-        image = Image.open(io.BytesIO(image_data))
-        image.save(filepath, 'PNG')
-        print(f"[Generator] Image saved to {filepath}")
+        if image_data[:8] == _PNG_SIGNATURE:
+            # Validate from the IHDR chunk header instead of decoding the image.
+            if len(image_data) < 24 or image_data[12:16] != b'IHDR':
+                raise ValueError("PNG data is truncated or missing its IHDR chunk")
+            width, height = struct.unpack('>II', image_data[16:24])
+            if (width, height) != config.RESOLUTION:
+                logger.warning("Image is %sx%s, expected %sx%s.", width, height, config.RESOLUTION[0], config.RESOLUTION[1])
+            filepath.write_bytes(image_data)
+        else:
+            from PIL import Image # Only needed to convert non-PNG responses
+            image = Image.open(io.BytesIO(image_data))
+            image.save(filepath, 'PNG', optimize=False)
+        logger.info("Image saved to %s", filepath)
     except Exception as e:
-        print(f"[Generator] Error saving image {filepath}: {e}")
+        logger.error("Error saving image %s: %s", filepath, e)
         raise
 
+def _is_complete_png(path: Path) -> bool:
+    """Checks the PNG signature, the IHDR chunk header and the trailing IEND chunk, without decoding."""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(24)
+            f.seek(-len(_PNG_IEND_CHUNK), os.SEEK_END)
+            trailer = f.read()
+    except OSError:
+        return False # Missing, or too short to hold both ends
+    return header[:8] == _PNG_SIGNATURE and header[12:16] == b'IHDR' and trailer == _PNG_IEND_CHUNK
+
+def _store_in_cache(image_path: Path, cache_path: Path):
+    """Copies a generated panel into the response cache under a temporary name, then renames it into place."""
+    # Unique per thread, so two workers caching the same key don't share a temp file.
+    tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        shutil.copyfile(image_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
 def generate_panel(panel_data: dict, product_image_path: str = None) -> Path:
     """Generates a single panel image based on its data."""
     panel_id = panel_data["id"]
-    print(f"[Generator] Generating Panel {panel_id}...")
+    logger.info("Generating Panel %s...", panel_id)
     
     prompt = _construct_prompt(panel_data)
     
-    image_bytes = _call_openrouter_api(prompt, product_image_path=product_image_path)
-    
     filename = f"panel_{panel_id}.png"
     image_path = config.PANELS_DIR / filename
     
+    # Identical prompt, product image and model: reuse the earlier result instead of paying for another call.
+    cache_path = config.CACHE_DIR / f"{_response_cache_key(prompt, product_image_path)}.png"
+    if _is_complete_png(cache_path):
+        shutil.copyfile(cache_path, image_path)
+        logger.info("Panel %s restored from cache (%s).", panel_id, cache_path.name)
+        return image_path
+    if cache_path.exists():
+        logger.warning("Discarding corrupt cache entry %s for Panel %s.", cache_path.name, panel_id)
+        cache_path.unlink(missing_ok=True)
+    
+    image_bytes = _call_openrouter_api(prompt, product_image_path=product_image_path)
+    
     _save_image(image_bytes, image_path)
+    try:
+        _store_in_cache(image_path, cache_path)
+    except OSError as e:
+        # The panel is already saved; a cache failure only costs a future re-generation.
+        logger.warning("Could not cache Panel %s: %s", panel_id, e)
     
-    print(f"[Generator] Panel {panel_id} generated successfully.")
-    return image_path
\ No newline at end of file
+    logger.info("Panel %s generated successfully.", panel_id)
+    return image_path
+
+def generate_panels_batch(panel_list: list, product_image_path: str = None, on_panel_done: Callable[[int, Path], None] = None) -> dict:
+    """Generates several panels concurrently and returns a mapping of panel id to image path.
+
+    Each panel is an independent, network-bound API call, so the requests are
+    fanned out over a thread pool rather than issued one after another. If given,
+    on_panel_done(panel_id, image_path) is called as each panel finishes, while
+    the rest are still in flight.
+    """
+    if product_image_path and Path(product_image_path).exists():
+        # Encode the shared product image once up front so the workers don't all miss the cache together.
+        try:
+            _encode_image_to_base64(product_image_path)
+        except Exception:
+            pass # Each panel call reports the failure and proceeds without fusion.
+
+    results = {}
+    # One worker per panel, capped at MAX_PANELS so a large batch can't flood the API.
+    max_workers = max(1, min(len(panel_list), config.MAX_PANELS))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(generate_panel, panel_data, product_image_path=product_image_path): panel_data["id"]
+            for panel_data in panel_list
+        }
+        for future in as_completed(futures):
+            panel_id = futures[future]
+            results[panel_id] = future.result()
+            if on_panel_done:
+                on_panel_done(panel_id, results[panel_id])
+    return results
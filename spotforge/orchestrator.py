@@ -1,45 +1,86 @@
 # spotforge/orchestrator.py
 
-import json
+import copy
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 from spotforge import config
+from spotforge.utils import json_dumps, json_loads, panel_log_path, append_panel_update, apply_panel_updates, upgrade_plan_layout
 from spotforge.prompter import create_initial_plan, create_edit_prompt_for_panel
-from spotforge.generator import generate_panel
-from spotforge.exporter import export_final_storyboard
+from spotforge.generator import generate_panels_batch
+from spotforge.exporter import export_final_storyboard, prepare_panel_segment
+
+logger = logging.getLogger(__name__)
 
 SHOT_PLAN_FILENAME = "shot_plan.json"
 
-def _save_shot_plan(plan: dict, filepath: Path):
-    """Saves the shot plan to a JSON file."""
+# Parsed shot plans by path, with the plan and panel-log signatures they were read at.
+_PLAN_CACHE: Dict[Path, Tuple[tuple, dict]] = {}
+
+def _save_shot_plan(plan: dict, filepath: Path, durable: bool = False):
+    """Saves the shot plan to a JSON file, atomically replacing any previous version.
+
+    With durable=True the data is fsynced before the rename; reserve that for
+    the final save of an operation. The saved plan supersedes the panel log,
+    which is cleared afterwards.
+    """
+    tmp_path = filepath.with_suffix(filepath.suffix + '.tmp')
     try:
-        with open(filepath, 'w') as f:
-            json.dump(plan, f, indent=4)
-        print(f"[Orchestrator] Shot plan saved to {filepath}")
+        # Write next to the target and rename over it, so a crash mid-write
+        # never leaves a truncated plan behind.
+        with open(tmp_path, 'wb') as f:
+            f.write(json_dumps(plan))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+        panel_log_path(filepath).unlink(missing_ok=True)
+        logger.info("Shot plan saved to %s", filepath)
     except Exception as e:
-        print(f"[Orchestrator] Error saving shot plan: {e}")
+        logger.error("Error saving shot plan: %s", e)
+
+def _file_signature(path: Path):
+    """Returns (inode, mtime, size) for path, or None if it does not exist."""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
 def _load_shot_plan(filepath: Path) -> dict:
-    """Loads the shot plan from a JSON file."""
+    """Loads the shot plan from a JSON file, replaying any panel updates logged since it was written.
+
+    Parsed plans are cached in-process and reused while neither the plan file
+    nor its panel log has changed; callers always get their own copy.
+    """
     try:
-        with open(filepath, 'r') as f:
-            return json.load(f)
+        plan_signature = _file_signature(filepath)
+        if plan_signature is None:
+            raise FileNotFoundError(filepath)
+        signature = (plan_signature, _file_signature(panel_log_path(filepath)))
+        cached = _PLAN_CACHE.get(filepath)
+        if cached is None or cached[0] != signature:
+            plan = apply_panel_updates(upgrade_plan_layout(json_loads(filepath.read_bytes())), filepath)
+            cached = _PLAN_CACHE[filepath] = (signature, plan)
+        # Callers mutate the plan they get back, so never hand out the cached one.
+        return copy.deepcopy(cached[1])
     except FileNotFoundError:
-        print(f"[Orchestrator] Shot plan file not found: {filepath}")
+        logger.error("Shot plan file not found: %s", filepath)
         return None
     except Exception as e:
-        print(f"[Orchestrator] Error loading shot plan: {e}")
+        logger.error("Error loading shot plan: %s", e)
         return None
 
 def generate_storyboard(brief: str, image_path: str, style: str, brand_color: str = None) -> bool:
     """Orchestrates the full storyboard generation process."""
-    print(f"[Orchestrator] Received request to generate storyboard.")
-    print(f"  Brief: {brief}")
-    print(f"  Product Image: {image_path}")
-    print(f"  Style: {style}")
-    print(f"  Color: {brand_color}")
+    logger.info("Received request to generate storyboard.")
+    logger.info("Brief: %s | Product Image: %s | Style: %s | Color: %s", brief, image_path, style, brand_color)
     
     try:
-        print("[Orchestrator] Stage 1: Planning...")
+        logger.info("Stage 1: Planning...")
         shot_plan = create_initial_plan(brief, style)
         
         shot_plan["product_image_path"] = image_path
@@ -47,113 +88,162 @@ def generate_storyboard(brief: str, image_path: str, style: str, brand_color: st
         plan_file_path = config.PROJECT_ROOT / SHOT_PLAN_FILENAME
         _save_shot_plan(shot_plan, plan_file_path)
         
-        print("[Orchestrator] Stage 2: Generating panels...")
-        shot_plan = _load_shot_plan(plan_file_path)
-        
-        if not shot_plan:
-            print("[Orchestrator] Failed to load shot plan for generation.")
-            return False
-            
+        logger.info("Stage 2: Generating panels...")
         product_image_path = shot_plan.get("product_image_path")
         if not product_image_path or not Path(product_image_path).exists():
-             print(f"[Orchestrator] Warning: Product image path '{product_image_path}' is invalid or missing. Proceeding without fusion.")
+             logger.warning("Product image path '%s' is invalid or missing. Proceeding without fusion.", product_image_path)
              product_image_path = None
 
-        panel_ids = sorted(shot_plan.get("panels", {}).keys(), key=int)
-        for panel_id_str in panel_ids:
-            panel_id = int(panel_id_str)
-            panel_data = shot_plan["panels"][panel_id_str]
-            
-            print(f"[Orchestrator] --- Generating Panel {panel_id} ---")
-            image_path_obj = generate_panel(panel_data, product_image_path=product_image_path)
-            
-            shot_plan["panels"][panel_id_str]["generated_image_path"] = str(image_path_obj)
-            
-            _save_shot_plan(shot_plan, plan_file_path)
-            
-        print("[Orchestrator] All panels generated successfully!")
-        print("[Orchestrator] Full storyboard generation complete!")
+        panel_list = shot_plan.get("panels", [])
+        # Consistent elements are stored once per plan; the generator expects
+        # them on each panel it renders.
+        consistent_elements = shot_plan.get("consistent_elements", "")
+        panel_requests = [{**panel_data, "consistent_elements": consistent_elements} for panel_data in panel_list]
+
+        logger.info("Generating %s panels in parallel", len(panel_list))
+        with ThreadPoolExecutor(max_workers=1) as segment_encoder:
+            def on_panel_done(panel_id: int, path: Path):
+                # Record the panel in the append-only log so it survives an
+                # interrupted run, then encode its video segment while the
+                # remaining API calls are still in flight.
+                append_panel_update(plan_file_path, {"id": panel_id, "generated_image_path": str(path)})
+                segment_encoder.submit(prepare_panel_segment, path)
+
+            generated_paths = generate_panels_batch(
+                panel_requests,
+                product_image_path=product_image_path,
+                on_panel_done=on_panel_done,
+            )
+
+        for panel_data in panel_list:
+            panel_data["generated_image_path"] = str(generated_paths[panel_data["id"]])
+
+        _save_shot_plan(shot_plan, plan_file_path, durable=True)
+
+        logger.info("All panels generated successfully!")
+        logger.info("Full storyboard generation complete!")
         return True
         
     except Exception as e:
-        print(f"[Orchestrator] Error during generation: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error("Error during generation: %s", e)
+        logger.debug("Generation traceback:", exc_info=True)
         return False
 
 def edit_panel(panel_id: int, instruction: str) -> bool:
     """Orchestrates the editing of a specific panel."""
-    print(f"[Orchestrator] Received request to edit panel {panel_id}.")
-    print(f"  Instruction: {instruction}")
+    logger.info("Received request to edit panel %s.", panel_id)
+    logger.info("Instruction: %s", instruction)
+    return edit_panels([(panel_id, instruction)])
+
+def edit_panels(edits: List[Tuple[int, str]]) -> bool:
+    """Applies several (panel_id, instruction) edits, loading and saving the shot plan once.
+
+    The edited panels are regenerated concurrently. Empty instructions are
+    skipped, and if a panel is listed more than once only its last instruction
+    is applied.
+    """
+    # Edits always start from the panel's original scene description, so a
+    # later instruction for the same panel supersedes an earlier one.
+    instructions = {}
+    for panel_id, instruction in edits:
+        if not instruction or not instruction.strip():
+            logger.info("Empty edit instruction; panel %s left unchanged.", panel_id)
+            continue
+        instructions[panel_id] = instruction
+    if not instructions:
+        return True
     
     try:
         plan_file_path = config.PROJECT_ROOT / SHOT_PLAN_FILENAME
         shot_plan = _load_shot_plan(plan_file_path)
         
         if not shot_plan:
-            print("[Orchestrator] Cannot edit: Shot plan not found.")
+            logger.error("Cannot edit: Shot plan not found.")
             return False
 
-        panel_id_str = str(panel_id)
-        if panel_id_str not in shot_plan.get("panels", {}):
-            print(f"[Orchestrator] Error: Panel ID {panel_id} not found in shot plan.")
-            return False
+        # Panels are stored in id order starting at 1, so the id is the position.
+        panels = shot_plan.get("panels", [])
+        for panel_id in instructions:
+            if not 1 <= panel_id <= len(panels):
+                logger.error("Panel ID %s not found in shot plan.", panel_id)
+                return False
 
-        current_panel_data = shot_plan["panels"][panel_id_str]
-        print(f"[Orchestrator] Editing Panel {panel_id}: {current_panel_data.get('goal', 'No goal found')}")
+        consistent_elements = shot_plan.get("consistent_elements", "")
+        edit_requests = []
+        for panel_id, instruction in instructions.items():
+            current_panel_data = panels[panel_id - 1]
+            logger.info("Editing Panel %s: %s", panel_id, current_panel_data.get('goal', 'No goal found'))
 
-        consistent_elements = current_panel_data.get("consistent_elements", "")
-        original_scene_desc = current_panel_data.get("scene_description", "")
-        original_full_prompt_for_editing = f"Scene Description:\n{original_scene_desc}\n\nConsistent Elements:\n{consistent_elements}"
+            original_scene_desc = current_panel_data.get("scene_description", "")
+            original_full_prompt_for_editing = f"Scene Description:\n{original_scene_desc}\n\nConsistent Elements:\n{consistent_elements}"
 
-        print("[Orchestrator] Creating edited prompt...")
-        edited_prompt = create_edit_prompt_for_panel(
-            current_panel_prompt=original_full_prompt_for_editing,
-            edit_instruction=instruction,
-            consistent_elements=consistent_elements
-        )
-        print(f"[Orchestrator] Edited prompt created.")
+            logger.debug("Creating edited prompt...")
+            edited_prompt = create_edit_prompt_for_panel(
+                current_panel_prompt=original_full_prompt_for_editing,
+                edit_instruction=instruction,
+                consistent_elements=consistent_elements
+            )
+            logger.debug("Edited prompt created.")
+
+            edit_requests.append({
+                "id": panel_id,
+                "scene_description": edited_prompt,
+                "consistent_elements": consistent_elements,
+                "goal": current_panel_data.get("goal", ""),
+            })
+
+        def on_panel_done(panel_id: int, path: Path):
+            # Apply and journal each edit as it lands, so finished edits
+            # survive even if another one in the batch fails.
+            panel_data = panels[panel_id - 1]
+            panel_data["generated_image_path"] = str(path)
+            panel_data.setdefault("edit_history", []).append(instructions[panel_id])
+            append_panel_update(plan_file_path, {
+                "id": panel_id,
+                "generated_image_path": panel_data["generated_image_path"],
+                "edit_history": panel_data["edit_history"],
+            })
 
         # Get the global product image path for fusion during edit
         product_image_path = shot_plan.get("product_image_path")
 
-        edited_panel_data = {
-            "id": panel_id,
-            "scene_description": edited_prompt,
-            "consistent_elements": consistent_elements,
-            "goal": current_panel_data.get("goal", ""),
-        }
+        logger.info("Calling generator for %s edited panel(s)...", len(edit_requests))
+        generate_panels_batch(edit_requests, product_image_path=product_image_path, on_panel_done=on_panel_done)
         
-        print(f"[Orchestrator] Calling generator for edited Panel {panel_id}...")
-        new_image_path = generate_panel(edited_panel_data, product_image_path=product_image_path) # Pass product_image_path here too
+        _save_shot_plan(shot_plan, plan_file_path, durable=True)
         
-        shot_plan["panels"][panel_id_str]["generated_image_path"] = str(new_image_path)
-        if "edit_history" not in shot_plan["panels"][panel_id_str]:
-            shot_plan["panels"][panel_id_str]["edit_history"] = []
-        shot_plan["panels"][panel_id_str]["edit_history"].append(instruction)
-        
-        _save_shot_plan(shot_plan, plan_file_path)
-        
-        print(f"[Orchestrator] Panel {panel_id} updated successfully!")
+        for panel_id in instructions:
+            logger.info("Panel %s updated successfully!", panel_id)
         return True
         
     except Exception as e:
-        print(f"[Orchestrator] Error during panel edit: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error("Error during panel edit: %s", e)
+        logger.debug("Panel edit traceback:", exc_info=True)
         return False
 
+@contextmanager
+def open_plan(filepath: Path = None) -> Iterator[dict]:
+    """Loads the shot plan on enter and saves it once on exit, for scripted bulk changes.
+
+    Yields None, and saves nothing, if the plan cannot be loaded. The plan is
+    not saved if the block raises.
+    """
+    filepath = filepath or config.PROJECT_ROOT / SHOT_PLAN_FILENAME
+    shot_plan = _load_shot_plan(filepath)
+    yield shot_plan
+    if shot_plan is not None:
+        _save_shot_plan(shot_plan, filepath, durable=True)
+
 def export_storyboard(include_narration: bool = False, voice_id: str = 'default') -> bool:
     """Orchestrates the export process."""
-    print(f"[Orchestrator] Received request to export storyboard.")
-    print(f"  Include Narration: {include_narration}")
-    print(f"  Voice ID: {voice_id}")
+    logger.info("Received request to export storyboard.")
+    logger.info("Include Narration: %s | Voice ID: %s", include_narration, voice_id)
     
     success = export_final_storyboard(include_narration=include_narration, voice_id=voice_id)
     
     if success:
-        print("[Orchestrator] Export orchestrated successfully!")
+        logger.info("Export orchestrated successfully!")
     else:
-        print("[Orchestrator] Export orchestration failed.")
+        logger.error("Export orchestration failed.")
         
     return success
@@ -1,194 +1,216 @@
 # spotforge/prompter.py
 
+import copy
 import json
-from typing import Dict, Any, List
+import logging
+import re
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, List, Mapping, NamedTuple, Tuple
 from spotforge import config
 
-def _parse_brief(brief: str) -> Dict[str, Any]:
+logger = logging.getLogger(__name__)
+
+# (goal, scene description template, composition notes) for each of the six panels, in order.
+_SHOT_TEMPLATES = (
+    (
+        "Establish setting, mood, and introduce the product.",
+        "Establishing shot for a {main_idea}. "
+        "Setting: {background}. "
+        "Lighting: {lighting}, creating a {combined_mood} atmosphere. "
+        "Product: A {product_type} placed prominently, showing its shape and logo. "
+        "Details: Subtle elements suggesting {target} context. "
+        "Camera: Wide shot, 16:9 aspect ratio.",
+        "Rule of thirds, product slightly off-center.",
+    ),
+    (
+        "Show the product in use within the target context.",
+        "Mid-shot showing the {target} using the {product_type}. "
+        "Action: Holding, wearing, or interacting with the {product_type}. "
+        "Setting: Part of the {background}. "
+        "Lighting: {lighting}, emphasizing the texture and details. "
+        "Product Details: {product_title} shape, color, and logo clearly visible. "
+        "Camera: Medium shot, 16:9.",
+        "Focus on hands/product interaction, background slightly blurred.",
+    ),
+    (
+        "Highlight a key product feature.",
+        "Close-up shot focusing on a key feature of the {product_type}. "
+        "Example Feature: Logo detail, fabric texture, material quality. "
+        "Lighting: {lighting}, highlighting the feature. "
+        "Product Details: Clear view of the {product_type}'s design. "
+        "Setting: Continuation of {background}. "
+        "Camera: Close-up, 16:9.",
+        "Center focus on feature/detail, shallow depth of field.",
+    ),
+    (
+        "Imply social context or lifestyle benefit.",
+        "Wider lifestyle shot showing the {target} benefiting from the {product_type}. "
+        "Scene: {target} using/wearing the {product_type} in {background}. "
+        "Elements: Contextual items suggesting {target} lifestyle. "
+        "Lighting: {lighting}, creating an inviting scene. "
+        "Product: {product_type} visible and integrated naturally. "
+        "Camera: Wide/Medium shot, 16:9.",
+        "Show environment and implied use, product integrated naturally.",
+    ),
+    (
+        "Present the CTA and potentially the product packaging.",
+        "Flat lay or angled shot of the {product_type}, possibly next to its packaging. "
+        "Focus: Product packaging design, prominently displaying the CTA '{cta}'. "
+        "Setting: Clean section of {background}. "
+        "Lighting: {lighting}, ensuring product and text are well-lit. "
+        "Product: {product_type} and packaging shown clearly. "
+        "Text: '{cta}' visible and readable. "
+        "Camera: Top-down or slight angle, 16:9.",
+        "Clear view of packaging/CTA, product centered.",
+    ),
+    (
+        "Leave a strong final impression of the brand/product.",
+        "Artistic or symbolic closing shot. "
+        "Idea: The {product_type} alone, perhaps with subtle light rays or context. "
+        "Mood: Reinforce the {combined_mood} feeling. "
+        "Lighting: {lighting}, creating a sense of satisfaction. "
+        "Product: Strong, clear view of the {product_type} and its logo. "
+        "Background: Simplified version of {background}. "
+        "Camera: Tight composition, 16:9.",
+        "Strong visual impact, focus on brand/product essence.",
+    ),
+)
+
+# Read-only views of the presets, resolved once at import. A misconfigured
+# DEFAULT_STYLE fails here rather than on the first request.
+_PRESETS = {name: MappingProxyType(preset) for name, preset in config.PRESETS.items()}
+_DEFAULT_PRESET = _PRESETS[config.DEFAULT_STYLE]
+
+# Product keywords (matched anywhere in the brief, case-insensitively) and the product type each maps to.
+_KEYWORD_TO_PRODUCT_TYPE = {
+    't-shirt': 't-shirt',
+    'shirt': 't-shirt',
+    'mug': 'mug',
+    'sneaker': 'sneaker',
+    'shoe': 'sneaker',
+}
+_PRODUCT_RE = re.compile('(' + '|'.join(map(re.escape, _KEYWORD_TO_PRODUCT_TYPE)) + ')', re.IGNORECASE)
+
+# Brief components are separated by ';' and written as 'key: value', except the
+# leading main idea. Splitting on the regexes also drops surrounding whitespace.
+_BRIEF_RE = re.compile(r"\s*;\s*")
+_KV_RE = re.compile(r"\s*:\s*")
+
+class BriefComponents(NamedTuple):
+    """The components of a parsed brief; missing ones are empty strings."""
+    main_idea: str = ""
+    target: str = ""
+    mood: str = ""
+    cta: str = ""
+
+def _parse_brief(brief: str) -> BriefComponents:
     """Parses the one-sentence brief into key components."""
-    components = {}
-    parts = [part.strip() for part in brief.split(';')]
-    
-    if parts:
-        components['main_idea'] = parts[0]
+    components = dict.fromkeys(BriefComponents._fields, "")
+    main_idea, *parts = _BRIEF_RE.split(brief.strip())
+    components['main_idea'] = main_idea
         
-    for part in parts[1:]:
-        if ':' in part:
-            key, value = part.split(':', 1)
-            key = key.strip().lower()
-            value = value.strip().strip("'\"")
-            components[key] = value
-        else:
-            pass # Ignore parts without colon for now
-            
-    expected_keys = ['main_idea', 'target', 'mood', 'cta']
-    for key in expected_keys:
-        if key not in components:
-            components[key] = ""
+    for part in parts:
+        key_value = _KV_RE.split(part, maxsplit=1)
+        if len(key_value) == 2:
+            key, value = key_value
+            components[key.lower()] = value.strip("'\" \t")
+        # Ignore parts without colon for now
             
-    return components
+    # Keys other than the expected ones are not used downstream.
+    return BriefComponents(*(components[key] for key in BriefComponents._fields))
 
-def _select_preset(style_name: str) -> Dict[str, str]:
+def _select_preset(style_name: str) -> Mapping[str, str]:
     """Retrieves the preset configuration."""
-    return config.PRESETS.get(style_name, config.PRESETS[config.DEFAULT_STYLE])
+    return _PRESETS.get(style_name, _DEFAULT_PRESET)
 
 def _infer_product_type_from_brief(brief: str) -> str:
     """Attempts to infer the product type from the brief."""
     # Simple keyword matching - can be improved later
-    brief_lower = brief.lower()
-    if 't-shirt' in brief_lower or 'shirt' in brief_lower:
-        return 't-shirt'
-    elif 'mug' in brief_lower:
-        return 'mug'
-    elif 'sneaker' in brief_lower or 'shoe' in brief_lower:
-        return 'sneaker'
-    # Add more as needed
+    match = _PRODUCT_RE.search(brief)
+    if match:
+        return _KEYWORD_TO_PRODUCT_TYPE[match.group(1).lower()]
     return 'product' # Default fallback
 
-def _create_shot_list(brief_components: Dict[str, str], preset: Dict[str, str], product_type: str) -> List[Dict[str, Any]]:
-    """Creates a detailed 6-panel shot list based on parsed brief, preset, and product type."""
-    main_idea = brief_components.get('main_idea', '')
-    target = brief_components.get('target', '')
-    mood = brief_components.get('mood', '')
-    cta = brief_components.get('cta', '')
-    
-    lighting = preset.get('lighting', '')
-    background = preset.get('background', '')
-    preset_mood = preset.get('mood', '')
+def _create_shot_list(brief_components: BriefComponents, preset: Dict[str, str], product_type: str) -> Tuple[List[Dict[str, Any]], str]:
+    """Creates a detailed 6-panel shot list based on parsed brief, preset, and product type.
+
+    Returns the shot list together with the consistent-elements text shared by
+    every panel; it is stored once at the plan level rather than per panel.
+    """
+    # Every preset defines these fields.
+    main_idea, target, mood, cta = brief_components
+    lighting, background, preset_mood = preset['lighting'], preset['background'], preset['mood']
     
     combined_mood = f"{mood}, {preset_mood}".strip(', ')
     
     # Define consistent elements using the inferred product type
+    product_title = product_type.title()
     consistent_elements = (
-        f"{product_type.title()}: specific shape, color, logo visible. "
+        f"{product_title}: specific shape, color, logo visible. "
         "Protagonist: unseen or implied presence. "
         f"Consistent visual style: {combined_mood}, {lighting}, {background}. "
         "Maintain consistent aspect ratio (16:9) and camera perspective."
     )
     
-    shot_list = []
-    
-    shot_list.append({
-        "id": 1,
-        "goal": "Establish setting, mood, and introduce the product.",
-        "scene_description": (
-            f"Establishing shot for a {main_idea}. "
-            f"Setting: {background}. "
-            f"Lighting: {lighting}, creating a {combined_mood} atmosphere. "
-            f"Product: A {product_type} placed prominently, showing its shape and logo. "
-            f"Details: Subtle elements suggesting {target} context. "
-            f"Camera: Wide shot, 16:9 aspect ratio."
-        ),
-        "consistent_elements": consistent_elements,
-        "composition_notes": "Rule of thirds, product slightly off-center."
-    })
-    
-    # Repeat for panels 2-6, replacing 'mug' with {product_type}
-    shot_list.append({
-        "id": 2,
-        "goal": "Show the product in use within the target context.",
-        "scene_description": (
-            f"Mid-shot showing the {target} using the {product_type}. "
-            f"Action: Holding, wearing, or interacting with the {product_type}. "
-            f"Setting: Part of the {background}. "
-            f"Lighting: {lighting}, emphasizing the texture and details. "
-            f"Product Details: {product_type.title()} shape, color, and logo clearly visible. "
-            f"Camera: Medium shot, 16:9."
-        ),
-        "consistent_elements": consistent_elements,
-        "composition_notes": "Focus on hands/product interaction, background slightly blurred."
-    })
-    
-    shot_list.append({
-        "id": 3,
-        "goal": "Highlight a key product feature.",
-        "scene_description": (
-            f"Close-up shot focusing on a key feature of the {product_type}. "
-            f"Example Feature: Logo detail, fabric texture, material quality. "
-            f"Lighting: {lighting}, highlighting the feature. "
-            f"Product Details: Clear view of the {product_type}'s design. "
-            f"Setting: Continuation of {background}. "
-            f"Camera: Close-up, 16:9."
-        ),
-        "consistent_elements": consistent_elements,
-        "composition_notes": "Center focus on feature/detail, shallow depth of field."
-    })
-    
-    shot_list.append({
-        "id": 4,
-        "goal": "Imply social context or lifestyle benefit.",
-        "scene_description": (
-            f"Wider lifestyle shot showing the {target} benefiting from the {product_type}. "
-            f"Scene: {target} using/wearing the {product_type} in {background}. "
-            f"Elements: Contextual items suggesting {target} lifestyle. "
-            f"Lighting: {lighting}, creating an inviting scene. "
-            f"Product: {product_type} visible and integrated naturally. "
-            f"Camera: Wide/Medium shot, 16:9."
-        ),
-        "consistent_elements": consistent_elements,
-        "composition_notes": "Show environment and implied use, product integrated naturally."
-    })
-    
-    shot_list.append({
-        "id": 5,
-        "goal": "Present the CTA and potentially the product packaging.",
-        "scene_description": (
-            f"Flat lay or angled shot of the {product_type}, possibly next to its packaging. "
-            f"Focus: Product packaging design, prominently displaying the CTA '{cta}'. "
-            f"Setting: Clean section of {background}. "
-            f"Lighting: {lighting}, ensuring product and text are well-lit. "
-            f"Product: {product_type} and packaging shown clearly. "
-            f"Text: '{cta}' visible and readable. "
-            f"Camera: Top-down or slight angle, 16:9."
-        ),
-        "consistent_elements": consistent_elements,
-        "composition_notes": "Clear view of packaging/CTA, product centered."
-    })
-    
-    shot_list.append({
-        "id": 6,
-        "goal": "Leave a strong final impression of the brand/product.",
-        "scene_description": (
-            f"Artistic or symbolic closing shot. "
-            f"Idea: The {product_type} alone, perhaps with subtle light rays or context. "
-            f"Mood: Reinforce the {combined_mood} feeling. "
-            f"Lighting: {lighting}, creating a sense of satisfaction. "
-            f"Product: Strong, clear view of the {product_type} and its logo. "
-            f"Background: Simplified version of {background}. "
-            f"Camera: Tight composition, 16:9."
-        ),
-        "consistent_elements": consistent_elements,
-        "composition_notes": "Strong visual impact, focus on brand/product essence."
-    })
+    context = {
+        "main_idea": main_idea,
+        "target": target,
+        "cta": cta,
+        "lighting": lighting,
+        "background": background,
+        "combined_mood": combined_mood,
+        "product_type": product_type,
+        "product_title": product_title,
+    }
     
-    return shot_list
+    shot_list = [
+        {
+            "id": index,
+            "goal": goal,
+            "scene_description": scene_template.format_map(context),
+            "composition_notes": composition_notes,
+        }
+        for index, (goal, scene_template, composition_notes) in enumerate(_SHOT_TEMPLATES, start=1)
+    ]
+    
+    return shot_list, consistent_elements
 
-def create_initial_plan(brief: str, style: str) -> Dict[str, Any]:
-    """Main function to create the initial storyboard plan."""
-    print(f"[Prompter] Parsing brief: {brief}")
+@lru_cache(maxsize=128)
+def _build_initial_plan(brief: str, style: str) -> Dict[str, Any]:
+    """Builds the initial plan. Cached, so the result is shared and must not be mutated."""
+    logger.info("Parsing brief: %s", brief)
     brief_components = _parse_brief(brief)
     product_type = _infer_product_type_from_brief(brief) # Infer product type
-    print(f"[Prompter] Inferred product type: {product_type}")
-    print(f"[Prompter] Selected style: {style}")
+    logger.info("Inferred product type: %s", product_type)
+    logger.info("Selected style: %s", style)
     preset = _select_preset(style)
     
-    print("[Prompter] Creating shot list...")
-    shot_list = _create_shot_list(brief_components, preset, product_type) # Pass product_type
+    logger.debug("Creating shot list...")
+    shot_list, consistent_elements = _create_shot_list(brief_components, preset, product_type) # Pass product_type
     
     plan = {
         "original_brief": brief,
         "selected_style": style,
         "inferred_product_type": product_type, # Store the inferred type
-        "parsed_components": brief_components,
-        "preset_details": preset,
-        "panels": {panel["id"]: panel for panel in shot_list}
+        "parsed_components": brief_components._asdict(),
+        "preset_details": dict(preset),
+        "consistent_elements": consistent_elements, # Shared by every panel
+        "panels": shot_list # Ordered by panel id
     }
     
-    print("[Prompter] Initial plan created successfully.")
+    logger.info("Initial plan created successfully.")
     return plan
 
+def create_initial_plan(brief: str, style: str) -> Dict[str, Any]:
+    """Main function to create the initial storyboard plan."""
+    # The plan is a pure function of (brief, style); callers get their own
+    # copy because they fill in image paths and edit history.
+    return copy.deepcopy(_build_initial_plan(brief, style))
+
+@lru_cache(maxsize=64)
 def create_edit_prompt_for_panel(current_panel_prompt: str, edit_instruction: str, consistent_elements: str) -> str:
-    """Constructs a prompt for editing a specific panel."""
+    """Constructs a prompt for editing a specific panel. Repeated edits reuse the cached prompt."""
     edit_prompt = (
         f"Revise the following image generation prompt based on the instruction. "
         f"IMPORTANT: Ensure the elements listed under 'Consistent Elements' remain unchanged.\n\n"
@@ -200,6 +222,7 @@ def create_edit_prompt_for_panel(current_panel_prompt: str, edit_instruction: st
     return edit_prompt
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="[%(name)s] %(levelname)s: %(message)s")
     test_brief = "Cozy autumn t-shirt launch; target: students; mood: warm; CTA: 'wear your focus'."
     test_style = "Warm Lifestyle"
     
@@ -0,0 +1,68 @@
+# spotforge/utils.py
+
+import json
+
+try:
+    import orjson
+except ImportError: # orjson is optional (pip install spotforge[fast])
+    orjson = None
+
+def json_loads(data):
+    """Parses JSON from bytes or str, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj, indent: bool = True) -> bytes:
+    """Serializes obj to UTF-8 JSON bytes (two-space indented by default), using orjson when it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
+
+def upgrade_plan_layout(plan: dict) -> dict:
+    """Converts a shot plan written by an older version to the current layout, in place.
+
+    Older plans keyed panels by id (a string once round-tripped through JSON)
+    and repeated the consistent elements on every panel. Panels are now a list
+    in id order, and the consistent elements are stored once on the plan.
+    """
+    panels = plan.get("panels")
+    if isinstance(panels, dict):
+        panels = plan["panels"] = [panel for _, panel in sorted(panels.items(), key=lambda item: int(item[0]))]
+    if "consistent_elements" not in plan and panels:
+        plan["consistent_elements"] = panels[0].get("consistent_elements", "")
+    return plan
+
+def panel_log_path(plan_path):
+    """Returns the append-only panel log that accompanies a shot plan file (shot_plan.json -> shot_plan.panels.ndjson)."""
+    return plan_path.with_name(plan_path.stem + ".panels.ndjson")
+
+def append_panel_update(plan_path, update: dict):
+    """Appends one panel update as a single JSON line to the plan's panel log.
+
+    Each append is one O_APPEND write, so concurrent writers don't interleave
+    and the cost is proportional to the update, not to the whole plan.
+    """
+    with open(panel_log_path(plan_path), 'ab') as f:
+        f.write(json_dumps(update, indent=False) + b"\n")
+
+def apply_panel_updates(plan: dict, plan_path) -> dict:
+    """Replays panel updates logged since the plan file was last written onto plan, in order."""
+    try:
+        lines = panel_log_path(plan_path).read_bytes().splitlines()
+    except FileNotFoundError:
+        return plan
+
+    panels_by_id = {panel["id"]: panel for panel in plan.get("panels", [])}
+    for line in lines:
+        try:
+            update = json_loads(line)
+        except ValueError:
+            continue # Torn final line from an interrupted append
+        panel = panels_by_id.get(update.get("id"))
+        if panel is not None:
+            panel.update(update)
+    return plan